@@ -753,13 +753,14 @@ class Encoder(nn.Module):
 
         # concatenate
         if self.mask_channel:
+            # broadcast views are enough here, torch.cat writes the full output anyway
             if mask is None:
-                mask = torch.ones((bsz, 1, H, W)).to(image.device)
+                mask = image.new_ones((1, 1, 1, 1)).expand(bsz, 1, H, W)
             else:
                 if mask.dim() != 4:
                     mask = mask.unsqueeze(0)
                 if mask.shape[0] != bsz:
-                    mask = mask.repeat(bsz, 1, 1, 1)
+                    mask = mask.expand(bsz, -1, -1, -1)
             concat = torch.cat([image, tp, mask], dim=1)
         else:
             concat = torch.cat([image, tp], dim=1)
@@ -26,12 +26,6 @@ class MaskMark:
         # network
         self.encoder_decoder = WatermarkModel(**model_config).to(device)
 
-        if hasattr(self.encoder_decoder.noise.noise, "list"):
-            for model in self.encoder_decoder.noise.noise.list:
-                model.to(device)
-        else:
-            self.encoder_decoder.noise.noise.to(device)
-
         # optimizer
         self.opt_encoder_decoder = torch.optim.AdamW(
             filter(lambda p: p.requires_grad, self.encoder_decoder.parameters()), lr=lr
@@ -64,7 +58,9 @@ class MaskMark:
         self.encoder_decoder.train()
 
         with torch.enable_grad():
-            images, messages, mask = images.to(self.device), messages.to(self.device), mask.to(self.device)
+            images = images.to(self.device, non_blocking=True)
+            messages = messages.to(self.device, non_blocking=True)
+            mask = mask.to(self.device, non_blocking=True)
 
             encoded_images, _, decoded_messages, mask_gt, mask_pd = \
                 self.encoder_decoder(image=images, message=messages, mask=mask, use_jnd=use_jnd)
@@ -101,17 +97,15 @@ class MaskMark:
         decoded message error rate
         '''
         error_rate = self.decoded_message_error_rate_batch(messages, decoded_messages)
-        mask_pred_acc = (mask_gt.gt(0.5) == mask_pd.gt(0.5)).float().mean().item()
-
-        result = {
-            "error_rate": error_rate,
-            "mask_pred_acc": mask_pred_acc,
-            "psnr": psnr.item(),
-            "ssim": ssim.item(),
-            "enc_loss": enc_loss.item(),
-            "dec_loss": dec_loss.item(),
-            "total_loss": total_loss.item()
-        }
+        mask_pred_acc = (mask_gt.gt(0.5) == mask_pd.gt(0.5)).float().mean()
+
+        # read all the metrics back with a single device to host copy
+        metrics = torch.stack([
+            error_rate, mask_pred_acc, psnr, ssim, enc_loss.detach(), dec_loss.detach(), total_loss.detach()
+        ]).tolist()
+        result = dict(zip(
+            ["error_rate", "mask_pred_acc", "psnr", "ssim", "enc_loss", "dec_loss", "total_loss"], metrics
+        ))
         return result
 
     def decoded_message_error_rate(self, message, decoded_message):
@@ -123,12 +117,10 @@ class MaskMark:
         return error_rate
 
     def decoded_message_error_rate_batch(self, messages, decoded_messages):
-        error_rate = 0.0
-        batch_size = len(messages)
-        for i in range(batch_size):
-            error_rate += self.decoded_message_error_rate(messages[i], decoded_messages[i])
-        error_rate /= batch_size
-        return error_rate
+        """
+        Mean bit error rate over the batch, kept on the device as a 0-dim tensor.
+        """
+        return (messages.gt(0.5) != decoded_messages.gt(0.5)).float().mean()
 
     def save_model(self, path_encoder_decoder: str):
         torch.save(self.encoder_decoder.state_dict(), path_encoder_decoder)
@@ -8,6 +8,14 @@ class Noise(nn.Module):
 		super(Noise, self).__init__()
 		self.noise = eval(layers)
 
+	def compile_geometric_layers(self):
+		""" torch.compile the batched geometric layers, whose random parameters are all drawn on the device. """
+		layers = self.noise.list if isinstance(self.noise, Combined) else [self.noise]
+		for layer in layers:
+			if isinstance(layer, BatchedGeometric):
+				layer.compile(dynamic=False)
+		return self
+
 	def forward(self, image, mask):
 		results = self.noise(image, mask)
 		return results
@@ -18,6 +18,7 @@ from .valuemetric import (
     SaturationAdjustment
 )
 from .geometric import (
+    BatchedGeometric,
     Rotate,
     Perspective,
     HorizontalFlip,
@@ -15,6 +15,13 @@ class Combined(nn.Module):
 			list = [Identity()]
 		self.list = list
 
+	def _apply(self, fn, *args, **kwargs):
+		# the layers are kept out of the registered submodules (and of the state dict),
+		# but still follow .to() / .cuda() so the whole pipeline lives on the model device
+		for layer in self.list:
+			layer._apply(fn, *args, **kwargs)
+		return super(Combined, self)._apply(fn, *args, **kwargs)
+
 	def forward(self, image, mask):
 		id = get_random_int([0, len(self.list) - 1])
 		return self.list[id](image, mask)
@@ -9,8 +9,8 @@ import random
 
 import torch
 import torch.nn as nn
-import torchvision.transforms as transforms
-import torchvision.transforms.functional as F
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
 from torchvision.transforms.functional import InterpolationMode
 
 
@@ -22,23 +22,73 @@ class Identity(nn.Module):
         return image, mask
 
 
-class Rotate(nn.Module):
+class BatchedGeometric(nn.Module):
+    """ Base class for geometric augmentations warping a whole (B, C, H, W) batch with a single grid_sample. """
+
+    def __init__(self):
+        super(BatchedGeometric, self).__init__()
+        self._grid_cache = {}
+
+    def pixel_grid(self, height, width, device):
+        """ Homogeneous (x, y, 1) pixel coordinates of the output canvas, of shape (H, W, 3), cached per size. """
+        key = ("pixels", height, width, device)
+        if key not in self._grid_cache:
+            ys, xs = torch.meshgrid(
+                torch.arange(height, device=device, dtype=torch.float32),
+                torch.arange(width, device=device, dtype=torch.float32),
+                indexing='ij'
+            )
+            self._grid_cache[key] = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1)
+        return self._grid_cache[key]
+
+    @staticmethod
+    def normalize_grid(grid, height, width):
+        """ Map pixel coordinates to the [-1, 1] range expected by grid_sample (align_corners=False). """
+        x = (2 * grid[..., 0] + 1) / width - 1
+        y = (2 * grid[..., 1] + 1) / height - 1
+        return torch.stack([x, y], dim=-1)
+
+    @staticmethod
+    def warp(image, mask, grid):
+        # a mask shared by the whole batch, (C, H, W) or (1, C, H, W), is broadcast to per-sample masks
+        if mask.dim() == 3:
+            mask = mask.unsqueeze(0)
+        if mask.shape[0] != image.shape[0]:
+            mask = mask.expand(image.shape[0], -1, -1, -1)
+        grid = grid.to(image.dtype)
+        image = F.grid_sample(image, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        mask = F.grid_sample(
+            mask.to(image.dtype), grid, mode='nearest', padding_mode='zeros', align_corners=False
+        ).to(mask.dtype)
+        return image, mask
+
+
+class Rotate(BatchedGeometric):
     def __init__(self, min_angle=-10, max_angle=10):
         super(Rotate, self).__init__()
         self.min_angle = min_angle
         self.max_angle = max_angle
 
-    def get_random_angle(self):
+    def get_random_angle(self, bsz, device):
         if self.min_angle is None or self.max_angle is None:
             raise ValueError("min_angle and max_angle must be provided")
-        return torch.randint(self.min_angle, self.max_angle + 1, size=(1,)).item()
+        return torch.randint(self.min_angle, self.max_angle + 1, size=(bsz,), device=device)
 
     def forward(self, image, mask, angle=None):
+        bsz, _, h, w = image.shape
         if angle is None:
-            angle = self.get_random_angle()
-        image = F.rotate(image, angle)
-        mask = F.rotate(mask, angle)
-        return image, mask
+            angle = self.get_random_angle(bsz, image.device)
+        angle = torch.as_tensor(angle, device=image.device).float().expand(bsz)
+        theta = torch.deg2rad(angle)
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        zeros = torch.zeros_like(cos)
+        # counter-clockwise rotation around the center, expressed in normalized coordinates
+        matrix = torch.stack([
+            torch.stack([cos, -sin * h / w, zeros], dim=-1),
+            torch.stack([sin * w / h, cos, zeros], dim=-1)
+        ], dim=1)
+        grid = F.affine_grid(matrix, [bsz, 1, h, w], align_corners=False)
+        return self.warp(image, mask, grid)
 
 
 class Resize(nn.Module):
@@ -46,13 +96,15 @@ class Resize(nn.Module):
         super(Resize, self).__init__()
         self.min_size = min_size  # float between 0 and 1, representing the total area of the output image compared to the input image
         self.max_size = max_size
+        # seeded from the global state, so runs stay reproducible under a global seed
+        self._rng = random.Random(random.getrandbits(64))
 
     def get_random_size(self, h, w):
         if self.min_size is None or self.max_size is None:
             raise ValueError("min_size and max_size must be provided")
         output_size = (
-            torch.randint(int(self.min_size * h), int(self.max_size * h) + 1, size=(1,)).item(),
-            torch.randint(int(self.min_size * w), int(self.max_size * w) + 1, size=(1,)).item()
+            self._rng.randint(int(self.min_size * h), int(self.max_size * h)),
+            self._rng.randint(int(self.min_size * w), int(self.max_size * w))
         )
         return output_size
 
@@ -62,8 +114,8 @@ class Resize(nn.Module):
             output_size = self.get_random_size(h, w)
         else:
             output_size = (int(size * h), int(size * w))
-        image = F.resize(image, output_size, antialias=True)
-        mask = F.resize(mask, output_size, interpolation=InterpolationMode.NEAREST)
+        image = TF.resize(image, output_size, antialias=True)
+        mask = TF.resize(mask, output_size, interpolation=InterpolationMode.NEAREST)
         return image, mask
 
 
@@ -72,13 +124,16 @@ class Crop(nn.Module):
         super(Crop, self).__init__()
         self.min_size = min_size
         self.max_size = max_size
+        # seeded from the global state, so runs stay reproducible under a global seed
+        self._rng = random.Random(random.getrandbits(64))
+        self._generators = {}
 
     def get_random_size(self, h, w):
         if self.min_size is None or self.max_size is None:
             raise ValueError("min_size and max_size must be provided")
         output_size = (
-            torch.randint(int(self.min_size * h), int(self.max_size * h) + 1, size=(1,)).item(),
-            torch.randint(int(self.min_size * w), int(self.max_size * w) + 1, size=(1,)).item()
+            self._rng.randint(int(self.min_size * h), int(self.max_size * h)),
+            self._rng.randint(int(self.min_size * w), int(self.max_size * w))
         )
         return output_size
 
@@ -88,24 +143,50 @@ class Crop(nn.Module):
             output_size = self.get_random_size(h, w)
         else:
             output_size = (int(size * h), int(size * w))
-        i, j, h, w = transforms.RandomCrop.get_params(image, output_size=output_size)
-        image = F.crop(image, i, j, h, w)
-        mask = F.crop(mask, i, j, h, w)
+        offsets = self.get_random_offsets(image.shape[0], h, w, output_size, image.device)
+        image = self.crop(image, offsets, output_size)
+        mask = self.crop(mask, offsets, output_size)
         return image, mask
 
+    def get_generator(self, device):
+        """ Device generator for the crop offsets, seeded once from self._rng. """
+        if device not in self._generators:
+            self._generators[device] = torch.Generator(device=device).manual_seed(self._rng.getrandbits(63))
+        return self._generators[device]
+
+    def get_random_offsets(self, bsz, h, w, output_size, device):
+        """ Per-sample (top, left) corners of the crop windows, of shape (B, 2). """
+        uniform = torch.rand(bsz, 2, device=device, generator=self.get_generator(device))
+        top = (uniform[:, 0] * (h - output_size[0] + 1)).long()
+        left = (uniform[:, 1] * (w - output_size[1] + 1)).long()
+        return torch.stack([top, left], dim=1)
+
+    @staticmethod
+    def crop(x, offsets, output_size):
+        bsz, c, h, w = x.shape
+        out_h, out_w = output_size
+        if (out_h, out_w) == (h, w):
+            return x
+        rows = offsets[:, :1] + torch.arange(out_h, device=x.device)
+        cols = offsets[:, 1:] + torch.arange(out_w, device=x.device)
+        x = x.gather(-2, rows[:, None, :, None].expand(bsz, c, out_h, w))
+        return x.gather(-1, cols[:, None, None, :].expand(bsz, c, out_h, out_w))
+
 
 class UpperLeftCrop(nn.Module):
     def __init__(self, min_size=None, max_size=None):
         super(UpperLeftCrop, self).__init__()
         self.min_size = min_size
         self.max_size = max_size
+        # seeded from the global state, so runs stay reproducible under a global seed
+        self._rng = random.Random(random.getrandbits(64))
 
     def get_random_size(self, h, w):
         if self.min_size is None or self.max_size is None:
             raise ValueError("min_size and max_size must be provided")
         output_size = (
-            torch.randint(int(self.min_size * h), int(self.max_size * h) + 1, size=(1,)).item(),
-            torch.randint(int(self.min_size * w), int(self.max_size * w) + 1, size=(1,)).item()
+            self._rng.randint(int(self.min_size * h), int(self.max_size * h)),
+            self._rng.randint(int(self.min_size * w), int(self.max_size * w))
         )
         return output_size
 
@@ -115,101 +196,122 @@ class UpperLeftCrop(nn.Module):
             output_size = self.get_random_size(h, w)
         else:
             output_size = (int(size * h), int(size * w))
-        i, j, h, w = transforms.RandomCrop.get_params(image, output_size=output_size)
-        image = F.crop(image, 0, 0, h, w)
-        mask = F.crop(mask, 0, 0, h, w)
+        image = TF.crop(image, 0, 0, *output_size)
+        mask = TF.crop(mask, 0, 0, *output_size)
         return image, mask
 
 
-class Perspective(nn.Module):
+class Perspective(BatchedGeometric):
     def __init__(self, min_distortion_scale=0.1, max_distortion_scale=0.5, random_seed=None):
         super(Perspective, self).__init__()
         self.min_distortion_scale = min_distortion_scale
         self.max_distortion_scale = max_distortion_scale
         self.random_seed = random_seed
     
-    def get_random_distortion_scale(self):
+    def get_random_distortion_scale(self, bsz, device, generator=None):
         if self.min_distortion_scale is None or self.max_distortion_scale is None:
             raise ValueError("min_distortion_scale and max_distortion_scale must be provided")
-        return self.min_distortion_scale + torch.rand(1).item() * \
-               (self.max_distortion_scale - self.min_distortion_scale)
+        return torch.empty(bsz, device=device).uniform_(
+            self.min_distortion_scale, self.max_distortion_scale, generator=generator
+        )
 
     def forward(self, image, mask, distortion_scale=None):
-        if distortion_scale is None:
-            distortion_scale = self.get_random_distortion_scale()
+        bsz, _, height, width = image.shape
+        if torch.is_tensor(distortion_scale) and distortion_scale.dim() == 0:
+            distortion_scale = float(distortion_scale)
+        if self.random_seed is None or torch.is_tensor(distortion_scale):
+            generator = None
+            if self.random_seed is not None:
+                generator = torch.Generator(device=image.device).manual_seed(self.random_seed)
+            grid = self.get_grid(bsz, height, width, image.device, distortion_scale, generator)
         else:
-            distortion_scale = distortion_scale
-        width, height = image.shape[-1], image.shape[-2]
-        startpoints, endpoints = self.get_perspective_params(width, height, distortion_scale, self.random_seed)
-        image = F.perspective(image, startpoints, endpoints)
-        mask = F.perspective(mask, startpoints, endpoints)
-        return image, mask
+            # with a fixed seed and scale every call draws the same warp, so its grid is computed only once
+            key = ("warp", bsz, height, width, image.device, distortion_scale)
+            if key not in self._grid_cache:
+                generator = torch.Generator(device=image.device).manual_seed(self.random_seed)
+                self._grid_cache[key] = self.get_grid(bsz, height, width, image.device, distortion_scale, generator)
+            grid = self._grid_cache[key]
+        return self.warp(image, mask, grid)
+
+    def get_grid(self, bsz, height, width, device, distortion_scale=None, generator=None):
+        if distortion_scale is None:
+            distortion_scale = self.get_random_distortion_scale(bsz, device, generator)
+        distortion_scale = torch.as_tensor(distortion_scale, device=device).float().expand(bsz)
+        startpoints, endpoints = self.get_perspective_params(width, height, distortion_scale, generator)
+        homography = self.get_homography(startpoints.double(), endpoints.double()).float()
+        points = self.pixel_grid(height, width, device) @ homography.transpose(1, 2)[:, None]
+        return self.normalize_grid(points[..., :2] / points[..., 2:], height, width)
 
     @staticmethod
-    def get_perspective_params(width, height, distortion_scale, random_seed=None):
-        half_height = height // 2
-        half_width = width // 2
-        
-        if random_seed is not None:
-            torch.manual_seed(random_seed)
-            random.seed(random_seed)
-        
-        topleft = [
-            int(torch.randint(0, int(distortion_scale * half_width) + 1, size=(1,)).item()),
-            int(torch.randint(0, int(distortion_scale * half_height) + 1, size=(1,)).item())
-        ]
-        topright = [
-            int(torch.randint(width - int(distortion_scale * half_width) - 1, width, size=(1,)).item()),
-            int(torch.randint(0, int(distortion_scale * half_height) + 1, size=(1,)).item())
-        ]
-        botright = [
-            int(torch.randint(width - int(distortion_scale * half_width) - 1, width, size=(1,)).item()),
-            int(torch.randint(height - int(distortion_scale * half_height) - 1, height, size=(1,)).item())
-        ]
-        botleft = [
-            int(torch.randint(0, int(distortion_scale * half_width) + 1, size=(1,)).item()),
-            int(torch.randint(height - int(distortion_scale * half_height) - 1, height, size=(1,)).item())
-        ]
-        startpoints = [[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]]
-        endpoints = [topleft, topright, botright, botleft]
-        return startpoints, endpoints
-
-
-class HorizontalFlip(nn.Module):
+    def get_homography(startpoints, endpoints):
+        """ Batched (B, 3, 3) homography mapping output `endpoints` back onto input `startpoints`, both (B, 4, 2). """
+        x, y = endpoints.unbind(-1)
+        u, v = startpoints.unbind(-1)
+        ones, zeros = torch.ones_like(x), torch.zeros_like(x)
+        rows_u = torch.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], dim=-1)
+        rows_v = torch.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], dim=-1)
+        coeffs = torch.linalg.solve(torch.cat([rows_u, rows_v], dim=1), torch.cat([u, v], dim=1))
+        return torch.cat([coeffs, torch.ones_like(coeffs[:, :1])], dim=1).view(-1, 3, 3)
+
+    def get_perspective_params(self, width, height, distortion_scale, generator=None):
+        """ Corner correspondences for per-sample (B,) distortion scales, as (B, 4, 2) startpoints and endpoints. """
+        bsz, device = distortion_scale.shape[0], distortion_scale.device
+        key = ("corners", height, width, device)
+        if key not in self._grid_cache:
+            self._grid_cache[key] = (
+                torch.tensor(
+                    [[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]],
+                    dtype=torch.float32, device=device
+                ),
+                torch.tensor([[1, 1], [-1, 1], [-1, -1], [1, -1]], dtype=torch.float32, device=device)
+            )
+        startpoints, signs = self._grid_cache[key]
+
+        # each corner moves inwards by at most distortion_scale * half the image size
+        limits = torch.stack([
+            (distortion_scale * (width // 2)).floor(),
+            (distortion_scale * (height // 2)).floor()
+        ], dim=-1)
+        uniform = torch.rand(bsz, 4, 2, device=device, generator=generator)
+        offsets = (uniform * (limits[:, None] + 1)).floor()
+        endpoints = startpoints + signs * offsets
+        return startpoints.expand(bsz, 4, 2), endpoints
+
+
+class HorizontalFlip(BatchedGeometric):
     def __init__(self):
         super(HorizontalFlip, self).__init__()
 
     def forward(self, image, mask, *args, **kwargs):
-        image = F.hflip(image)
-        mask = F.hflip(mask)
+        image = torch.flip(image, dims=(-1,))
+        mask = torch.flip(mask, dims=(-1,))
         return image, mask
 
 
-class CropResize(nn.Module):
+class CropResize(BatchedGeometric):
     def __init__(self, min_ratio=0.5, max_ratio=1):
         super(CropResize, self).__init__()
         self.min_ratio = min_ratio
         self.max_ratio = max_ratio
 
-    def get_random_ratio(self):
+    def get_random_ratio(self, bsz, device):
         if self.min_ratio is None or self.max_ratio is None:
             raise ValueError("min_ratio and max_ratio must be provided")
-        h_ratio = torch.empty(1).uniform_(self.min_ratio, self.max_ratio).item()
-        w_ratio = torch.empty(1).uniform_(self.min_ratio, self.max_ratio).item()
-        return h_ratio, w_ratio
+        return torch.empty(bsz, 2, device=device).uniform_(self.min_ratio, self.max_ratio)
 
     def forward(self, image, mask):
-        _, _, h, w = image.shape
-        h_ratio, w_ratio = self.get_random_ratio()
-        crop_h, crop_w = int(h * h_ratio), int(w * w_ratio)
-
-        top = torch.randint(0, h - crop_h + 1, (1,)).item()
-        left = torch.randint(0, w - crop_w + 1, (1,)).item()
-
-        image = F.crop(image, top, left, crop_h, crop_w)
-        mask = F.crop(mask, top, left, crop_h, crop_w)
-
-        image = F.resize(image, (h, w))
-        mask = F.resize(mask, (h, w), interpolation=InterpolationMode.NEAREST)
-
-        return image, mask
+        bsz, _, h, w = image.shape
+        ratio = self.get_random_ratio(bsz, image.device)
+        crop_h, crop_w = (ratio[:, 0] * h).floor(), (ratio[:, 1] * w).floor()
+        uniform = torch.rand(bsz, 2, device=image.device)
+        top = (uniform[:, 0] * (h - crop_h + 1)).floor()
+        left = (uniform[:, 1] * (w - crop_w + 1)).floor()
+        zeros = torch.zeros_like(crop_h)
+
+        # crop and resize back to (h, w) fused into one affine map from the output canvas to the crop window
+        matrix = torch.stack([
+            torch.stack([crop_w / w, zeros, (2 * left + crop_w) / w - 1], dim=-1),
+            torch.stack([zeros, crop_h / h, (2 * top + crop_h) / h - 1], dim=-1)
+        ], dim=1)
+        grid = F.affine_grid(matrix, [bsz, 1, h, w], align_corners=False)
+        return self.warp(image, mask, grid)
@@ -8,6 +8,7 @@ import os
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision import transforms
 from PIL import Image
 import random, string
@@ -174,7 +175,8 @@ class JpegBasic(nn.Module):
 		# pad the image so that we can do dct on 8x8 blocks
 		pad_height = (8 - image.shape[2] % 8) % 8
 		pad_width = (8 - image.shape[3] % 8) % 8
-		image = nn.ZeroPad2d((0, pad_width, 0, pad_height))(image)
+		if pad_width or pad_height:
+			image = F.pad(image, (0, pad_width, 0, pad_height))
 
 		# convert to yuv
 		image_yuv = self.rgb2yuv(image)
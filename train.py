@@ -60,7 +60,8 @@ def main(args):
         num_workers=8,
         random_nb_object=True,
         multi_w=False,
-        max_nb_masks=3
+        max_nb_masks=3,
+        device=device
     )
 
     network = MaskMark(**train_config, model_config=model_config)
@@ -100,6 +101,14 @@ def main(args):
         "total_loss": 0.0,
     }
 
+    # build the augmentation pipelines once, on the training device
+    noise = Noise(noise_layers).to(device)
+    ft_noise = Noise(ft_noise_layers).to(device) if is_ft and ft_noise_layers else noise
+    if train_config.get("compile_noise", False):
+        noise.compile_geometric_layers()
+        if ft_noise is not noise:
+            ft_noise.compile_geometric_layers()
+
     start_time = time.time()
     add_noise = False
     add_all_mask = False
@@ -109,18 +118,15 @@ def main(args):
         for images, masks in tqdm(train_dataloader):
             
             num += 1
+            images = images.to(device, non_blocking=True).float().div_(127.5).sub_(1.0)
+            masks = masks.to(device, non_blocking=True).float()
             bsz, C, H, W = images.shape
 
             if num > 500 or is_ft:
                 add_all_mask = True
 
             if (num > 1000 and not add_noise) or is_ft:
-                network.encoder_decoder.noise = Noise(noise_layers)
-                if hasattr(network.encoder_decoder.noise.noise, "list"):
-                    for model in network.encoder_decoder.noise.noise.list:
-                        model.to(device)
-                else:
-                    network.encoder_decoder.noise.noise.to(device)
+                network.encoder_decoder.noise = noise
                 add_noise = True
 
             if num > num_training_steps * train_config["start_jnd_ratio"] or is_ft:
@@ -138,19 +144,12 @@ def main(args):
 
             if is_ft:
                 if random.random() < 0.5:
-                    used_noise_layers = ft_noise_layers
+                    network.encoder_decoder.noise = ft_noise
                     if full_mask_ft:
                         mask = full_mask_embedder(images)
                         mask = torch.from_numpy(mask)
                 else:
-                    used_noise_layers = noise_layers
-
-                network.encoder_decoder.noise = Noise(used_noise_layers)
-                if hasattr(network.encoder_decoder.noise.noise, "list"):
-                    for model in network.encoder_decoder.noise.noise.list:
-                            model.to(device)
-                else:
-                    network.encoder_decoder.noise.noise.to(device)
+                    network.encoder_decoder.noise = noise
 
             result = network.train(images=images, messages=message, mask=mask, use_jnd=use_jnd)
 
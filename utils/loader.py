@@ -6,25 +6,73 @@
 
 import os
 import functools
+import hashlib
+import json
 import numpy as np
 from pycocotools import mask as maskUtils
 import random
+from typing import Union
 
 import torch
-import torch.nn.functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, default_collate
 from torchvision.datasets import CocoDetection
-from torchvision.datasets.folder import is_image_file
-from torchvision.transforms import Compose, ToTensor, Normalize, Resize, CenterCrop, InterpolationMode
+from torchvision.transforms import v2, InterpolationMode
+
+
+IMG_EXTENSIONS = (".jpg", ".jpeg", ".png", ".ppm", ".bmp", ".pgm", ".tif", ".tiff", ".webp")
+PATHS_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "maskmark")
+
+
+def _scan_image_paths(path, paths, dir_mtimes):
+    # unreadable directories are skipped, like os.walk does by default
+    try:
+        dir_mtimes[path] = os.stat(path).st_mtime
+        entries = list(os.scandir(path))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            _scan_image_paths(entry.path, paths, dir_mtimes)
+        elif entry.name.lower().endswith(IMG_EXTENSIONS) and entry.is_file():
+            paths.append(entry.path)
+
+
+def _is_listing_fresh(dir_mtimes):
+    try:
+        return all(os.stat(d).st_mtime == mtime for d, mtime in dir_mtimes.items())
+    except OSError:
+        return False
 
 
 @functools.lru_cache()
 def get_image_paths(path):
-    paths = []
-    for path, _, files in os.walk(path):
-        for filename in files:
-            paths.append(os.path.join(path, filename))
-    return sorted([fn for fn in paths if is_image_file(fn)])
+    """ Sorted image files under `path`. The listing is persisted in PATHS_CACHE_DIR together with
+    the modification times of every scanned directory, and reused while none of them changed. """
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        return []
+    cache_file = os.path.join(PATHS_CACHE_DIR, f"paths_{hashlib.md5(path.encode()).hexdigest()}.json")
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if _is_listing_fresh(cached["dirs"]):
+                return cached["paths"]
+        except (OSError, ValueError, KeyError):
+            pass  # unreadable cache, rescan
+
+    paths, dir_mtimes = [], {}
+    _scan_image_paths(path, paths, dir_mtimes)
+    paths.sort()
+    try:
+        os.makedirs(PATHS_CACHE_DIR, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"dirs": dir_mtimes, "paths": paths}, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass  # the cache is only an optimization
+    return paths
 
 
 class CocoImageIDWrapper(CocoDetection):
@@ -34,6 +82,16 @@ class CocoImageIDWrapper(CocoDetection):
         self.max_nb_masks = max_nb_masks
         self.multi_w = multi_w
         self.is_train = is_train
+        self._rle_cache = {}
+
+        # CSR-style index of the annotation ids of every image and array of image sizes,
+        # so that loading a sample does not go through the COCO dictionaries
+        ann_ids = [self.coco.getAnnIds(id) for id in self.ids]
+        self._ann_off = np.cumsum([0] + [len(aids) for aids in ann_ids]).astype(np.int64)
+        self._ann_ids_flat = np.array([aid for aids in ann_ids for aid in aids], dtype=np.int64)
+        self._img_hw = np.array(
+            [(info['height'], info['width']) for info in self.coco.loadImgs(self.ids)], dtype=np.int64
+        ).reshape(-1, 2)
     
     def __getitem__(self, index: int) -> tuple[torch.Tensor, np.ndarray]:
         if not isinstance(index, int):
@@ -41,97 +99,100 @@ class CocoImageIDWrapper(CocoDetection):
 
         id = self.ids[index]
         img = self._load_image(id)
-        mask = self._load_mask(id)
+        mask = self._load_mask(index)
         if mask is None:
             return None  # Skip this image if no valid mask is available
 
         img, mask = self.transforms(img, mask)
         return img, mask
 
-    def _load_mask(self, id):
-        anns = self.coco.loadAnns(self.coco.getAnnIds(id))
-        if not anns:
+    def _get_rles(self, index):
+        """ Compressed RLEs of the annotations of an image, converted from polygons only once. """
+        if index not in self._rle_cache:
+            ann_ids = self._ann_ids_flat[self._ann_off[index]:self._ann_off[index + 1]]
+            anns = self.coco.loadAnns(ann_ids.tolist())
+            self._rle_cache[index] = [self.coco.annToRLE(ann) for ann in anns]
+        return self._rle_cache[index]
+
+    def _load_mask(self, index):
+        rles = self._get_rles(index)
+        if not rles:
             return None  # Return None if there are no annotations
 
-        img_info = self.coco.loadImgs(id)[0]
-        original_height = img_info['height']
-        original_width = img_info['width']
+        original_height, original_width = self._img_hw[index].tolist()
 
-        # Initialize a list to hold all masks
-        masks = []
         if self.random_nb_object:
-            random.shuffle(anns)
+            rles = random.sample(rles, len(rles))
 
         if not(self.multi_w):
-            mask = np.zeros((original_height, original_width), dtype=np.float32)
-            # one mask for all objects
-            for ann in anns:
-                rle = self.coco.annToRLE(ann)
-                m = maskUtils.decode(rle)
-                mask = np.maximum(mask, m)
-            mask = torch.tensor(mask, dtype=torch.float32)
-            return mask[None, ...]  # Add channel dimension
+            # one mask for all objects, decoded in a single call as a (H, W, N) array
+            # masks stay uint8 until they are on the GPU
+            mask = maskUtils.decode(rles).max(axis=2)
+            return torch.from_numpy(mask)[None, ...]  # Add channel dimension
         else:
             if self.is_train:
                 nb_masks = np.random.randint(1, self.max_nb_masks+1)
             else:
                 nb_masks = self.max_nb_masks
-            anns = anns[:nb_masks]
-            for ann in anns:
-                rle = self.coco.annToRLE(ann)
-                m = maskUtils.decode(rle)
-                masks.append(m)
-            # Stack all masks along a new dimension to create a multi-channel mask tensor
-            if masks:
-                masks = np.stack(masks, axis=0)
-                masks = torch.tensor(masks, dtype=torch.float32)
-                # Check if the number of masks is less than max_nb_masks
-                if masks.shape[0] < nb_masks:
-                    # Calculate the number of additional zero masks needed
-                    additional_masks_count = nb_masks - masks.shape[0]
-                    # Create additional zero masks
-                    additional_masks = torch.zeros((additional_masks_count, original_height, original_width), dtype=torch.float32)
-                    # Concatenate the original masks with the additional zero masks
-                    masks = torch.cat([masks, additional_masks], dim=0)
-            else:
-                # Return a tensor of shape (max_nb_masks, height, width) filled with zeros if there are no masks
-                masks = torch.zeros((nb_masks, original_height, original_width), dtype=torch.float32)
-            return masks
+            rles = rles[:nb_masks]
+            # Decode straight into the final buffer, masks beyond the number of objects stay zero
+            masks = np.zeros((nb_masks, original_height, original_width), dtype=np.uint8)
+            masks[:len(rles)] = maskUtils.decode(rles).transpose(2, 0, 1)
+            return torch.from_numpy(masks)
 
 
 def custom_collate(batch: list) -> tuple[torch.Tensor, torch.Tensor]:
     batch = [item for item in batch if item is not None]
     if not batch:
         return torch.tensor([]), torch.tensor([])
-    
+
+    # Fast path: all samples have the same number of masks and can be stacked directly
+    if all(item[1].shape[0] == batch[0][1].shape[0] for item in batch):
+        return tuple(default_collate(batch))
+
     images, masks = zip(*batch)
     images = torch.stack(images)
     
-    # Find the maximum number of masks in any single image
+    # Pad each mask tensor to have 'max_masks' masks, in one preallocated output
     max_masks = max(mask.shape[0] for mask in masks)
-    if max_masks == 1:
-        masks = torch.stack(masks)
-        return images, masks
-
-    # Pad each mask tensor to have 'max_masks' masks and add the inverse mask
-    padded_masks = []
-    for mask in masks:
-        # Calculate the union of all masks in this image
-        union_mask = torch.max(mask, dim=0).values  # Assuming mask is of shape [num_masks, H, W]
-        
-        # Pad the mask tensor to have 'max_masks' masks
-        pad_size = max_masks - mask.shape[0]
-        if pad_size > 0:
-            padded_mask = F.pad(mask, pad=(0, 0, 0, 0, 0, pad_size), mode='constant', value=0)
-        else:
-            padded_mask = mask
-        
-        padded_masks.append(padded_mask)
+    out_masks = masks[0].new_zeros((len(masks), max_masks, *masks[0].shape[1:]))
+    for i, mask in enumerate(masks):
+        out_masks[i, :mask.shape[0]] = mask
     
-    # Stack the padded masks
-    masks = torch.stack(padded_masks)
-    
-    return images, masks
+    return images, out_masks
+
+
+class CudaPrefetcher:
+    """ Iterate over a DataLoader while the next batch is copied to the GPU on a side stream. """
+
+    def __init__(self, loader: DataLoader, device: str):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, loader):
+        try:
+            batch = next(loader)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return tuple(tensor.to(self.device, non_blocking=True) for tensor in batch)
+
+    def __iter__(self):
+        loader = iter(self.loader)
+        batch = self._preload(loader)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # the batch was allocated on the side stream but is consumed on the current one
+            for tensor in batch:
+                tensor.record_stream(current_stream)
+            next_batch = self._preload(loader)
+            yield batch
+            batch = next_batch
 
 
 def get_dataloader_segmentation(
@@ -145,17 +206,26 @@ def get_dataloader_segmentation(
     multi_w=False,
     max_nb_masks = 4,
     is_train=True,
-) -> DataLoader:
-    """ Get dataloader for COCO dataset. """
-    transform = Compose([        
-        Resize(image_size),
-        CenterCrop(image_size),
-        ToTensor(),
-        Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
+    device=None,
+) -> Union[DataLoader, CudaPrefetcher]:
+    """ Get dataloader for COCO dataset.
+
+    Workers are persistent, so the COCO index that CocoDetection builds in every worker
+    (self.coco) is parsed once per run instead of once per epoch. The number of workers
+    can be overridden with the MM_WORKERS environment variable.
+    If a CUDA `device` is given, the loader is wrapped in a CudaPrefetcher yielding batches
+    already on that device.
+    """
+    num_workers = int(os.environ.get("MM_WORKERS", num_workers))
+    # Images and masks are kept as uint8, the conversion to floats is done on the GPU by the training loop
+    transform = v2.Compose([
+        v2.ToImage(),
+        v2.Resize(image_size, antialias=True),
+        v2.CenterCrop(image_size)
     ])
-    mask_transform = Compose([        
-        Resize(image_size, interpolation=InterpolationMode.NEAREST),
-        CenterCrop(image_size)
+    mask_transform = v2.Compose([
+        v2.Resize(image_size, interpolation=InterpolationMode.NEAREST),
+        v2.CenterCrop(image_size)
     ])
     # Initialize the CocoDetection dataset
     dataset = CocoImageIDWrapper(
@@ -175,8 +245,13 @@ def get_dataloader_segmentation(
         shuffle=shuffle,
         num_workers=num_workers,
         pin_memory=True,
+        pin_memory_device="cuda" if torch.cuda.is_available() else "",
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
         drop_last=True,
         collate_fn=custom_collate
     )
 
+    if device is not None and torch.device(device).type == "cuda" and torch.cuda.is_available():
+        return CudaPrefetcher(dataloader, device)
     return dataloader